@@ -1,30 +1,43 @@
+import gzip
+import json
 import logging
 import os
 import re
-from collections import deque
+import tempfile
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain, islice
 from json.decoder import JSONDecodeError
+from operator import itemgetter
 from pathlib import Path
 from typing import (
     TYPE_CHECKING,
     Any,
-    Deque,
+    Callable,
     Dict,
     Iterable,
     Iterator,
     List,
     NamedTuple,
     NewType,
+    NoReturn,
     Optional,
     Tuple,
 )
 
 import gevent
 import requests
+from gevent.pool import Pool
+from requests.adapters import HTTPAdapter
 from typing_extensions import Literal
+from urllib3.util.retry import Retry
 
 from rotkehlchen.assets.asset import Asset
 from rotkehlchen.constants import ZERO
-from rotkehlchen.constants.assets import A_COMP, A_DAI, A_USD, A_USDT, A_WETH
+from rotkehlchen.constants.assets import A_COMP, A_USD
+from rotkehlchen.constants.timing import DAY_IN_SECONDS, DEFAULT_TIMEOUT_TUPLE
 from rotkehlchen.errors import (
     NoPriceForGivenTimestamp,
     PriceQueryUnsupportedAsset,
@@ -36,7 +49,6 @@ from rotkehlchen.fval import FVal
 from rotkehlchen.logging import RotkehlchenLogsAdapter
 from rotkehlchen.typing import ExternalService, Price, Timestamp
 from rotkehlchen.utils.misc import (
-    convert_to_int,
     get_or_make_price_history_dir,
     timestamp_to_date,
     ts_now,
@@ -49,111 +61,193 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 log = RotkehlchenLogsAdapter(logger)
 
-PRICE_HISTORY_FILE_PREFIX = 'cc_price_history_'
+PRICE_HISTORY_FILE_PREFIX = 'cc_columnar_price_history_'
+# Files of older versions that kept a list of full histohour entries. They are still read
+# if no columnar file exists for a pair but never written, so that older versions
+# can still read them.
+LEGACY_PRICE_HISTORY_FILE_PREFIX = 'cc_price_history_'
 
 
 T_PairCacheKey = str
 PairCacheKey = NewType('PairCacheKey', T_PairCacheKey)
 
 RATE_LIMIT_MSG = 'You are over your rate limit please upgrade your account!'
+RATE_LIMIT_MSG_BYTES = RATE_LIMIT_MSG.encode()
 CRYPTOCOMPARE_QUERY_RETRY_TIMES = 3
 CRYPTOCOMPARE_RATE_LIMIT_WAIT_TIME = 60
+# Identifiers of assets whose price cryptocompare can only find via an intermediary
+# asset, mapped to the identifier of that intermediary. Kept as plain strings so that
+# importing this module does not need to resolve all of these assets.
 CRYPTOCOMPARE_SPECIAL_CASES_MAPPING = {
-    Asset('TLN'): A_WETH,
-    Asset('BLY'): A_USDT,
-    Asset('cDAI'): A_DAI,
-    Asset('cCOMP'): A_COMP,
-    Asset('cBAT'): Asset('BAT'),
-    Asset('cREP'): Asset('REP'),
-    Asset('cSAI'): Asset('SAI'),
-    Asset('cUSDC'): Asset('USDC'),
-    Asset('cUSDT'): A_USDT,
-    Asset('cWBTC'): Asset('WBTC'),
-    Asset('cUNI'): Asset('UNI'),
-    Asset('cZRX'): Asset('ZRX'),
-    Asset('ADADOWN'): A_USDT,
-    Asset('ADAUP'): A_USDT,
-    Asset('BNBDOWN'): A_USDT,
-    Asset('BNBUP'): A_USDT,
-    Asset('BTCDOWN'): A_USDT,
-    Asset('BTCUP'): A_USDT,
-    Asset('ETHDOWN'): A_USDT,
-    Asset('ETHUP'): A_USDT,
-    Asset('EOSDOWN'): A_USDT,
-    Asset('EOSUP'): A_USDT,
-    Asset('DOTDOWN'): A_USDT,
-    Asset('DOTUP'): A_USDT,
-    Asset('LTCDOWN'): A_USDT,
-    Asset('LTCUP'): A_USDT,
-    Asset('TRXDOWN'): A_USDT,
-    Asset('TRXUP'): A_USDT,
-    Asset('XRPDOWN'): A_USDT,
-    Asset('XRPUP'): A_USDT,
-    Asset('DEXT'): A_USDT,
-    Asset('DOS'): A_USDT,
-    Asset('GEEQ'): A_USDT,
-    Asset('LINKDOWN'): A_USDT,
-    Asset('LINKUP'): A_USDT,
-    Asset('XTZDOWN'): A_USDT,
-    Asset('XTZUP'): A_USDT,
-    Asset('STAKE'): A_USDT,
-    Asset('MCB'): A_USDT,
-    Asset('TRB'): A_USDT,
-    Asset('YFI'): A_USDT,
-    Asset('YAM'): A_USDT,
-    Asset('DEC-2'): A_USDT,
-    Asset('ORN'): A_USDT,
-    Asset('PERX'): A_USDT,
-    Asset('PRQ'): A_USDT,
-    Asset('RING'): A_USDT,
-    Asset('SBREE'): A_USDT,
-    Asset('YFII'): A_USDT,
-    Asset('BZRX'): A_USDT,
-    Asset('CREAM'): A_USDT,
-    Asset('ADEL'): A_USDT,
-    Asset('ANK'): A_USDT,
-    Asset('CORN'): A_USDT,
-    Asset('SAL'): A_USDT,
-    Asset('CRT'): A_USDT,
-    Asset('FSW'): A_USDT,
-    Asset('JFI'): A_USDT,
-    Asset('PEARL'): A_USDT,
-    Asset('TAI'): A_USDT,
-    Asset('YFL'): A_USDT,
-    Asset('TRUMPWIN'): A_USDT,
-    Asset('TRUMPLOSE'): A_USDT,
-    Asset('KLV'): A_USDT,
-    Asset('KRT'): Asset('KRW'),
-    Asset('RVC'): A_USDT,
-    Asset('SDT'): A_USDT,
-    Asset('CHI'): A_USDT,
-    Asset('BAKE'): Asset('BNB'),
-    Asset('BURGER'): Asset('BNB'),
-    Asset('CAKE'): Asset('BNB'),
-    Asset('BREE'): A_USDT,
-    Asset('GHST'): A_USDT,
-    Asset('MEXP'): A_USDT,
-    Asset('POLS'): A_USDT,
-    Asset('RARI'): A_USDT,
-    Asset('VALUE'): A_USDT,
-    Asset('$BASED'): A_WETH,
-    Asset('DPI'): A_WETH,
-    Asset('JRT'): A_USDT,
-    Asset('PICKLE'): A_USDT,
-    Asset('FILDOWN'): A_USDT,
-    Asset('FILUP'): A_USDT,
-    Asset('YFIDOWN'): A_USDT,
-    Asset('YFIUP'): A_USDT,
-    Asset('BOT'): A_USDT,
-    Asset('SG'): A_USDT,
-    Asset('SPARTA'): Asset('BNB'),
-    Asset('MIR'): Asset('USDC'),
-    Asset('NDX'): A_WETH,
+    'TLN': 'WETH',
+    'BLY': 'USDT',
+    'cDAI': 'DAI',
+    'cCOMP': 'COMP',
+    'cBAT': 'BAT',
+    'cREP': 'REP',
+    'cSAI': 'SAI',
+    'cUSDC': 'USDC',
+    'cUSDT': 'USDT',
+    'cWBTC': 'WBTC',
+    'cUNI': 'UNI',
+    'cZRX': 'ZRX',
+    'ADADOWN': 'USDT',
+    'ADAUP': 'USDT',
+    'BNBDOWN': 'USDT',
+    'BNBUP': 'USDT',
+    'BTCDOWN': 'USDT',
+    'BTCUP': 'USDT',
+    'ETHDOWN': 'USDT',
+    'ETHUP': 'USDT',
+    'EOSDOWN': 'USDT',
+    'EOSUP': 'USDT',
+    'DOTDOWN': 'USDT',
+    'DOTUP': 'USDT',
+    'LTCDOWN': 'USDT',
+    'LTCUP': 'USDT',
+    'TRXDOWN': 'USDT',
+    'TRXUP': 'USDT',
+    'XRPDOWN': 'USDT',
+    'XRPUP': 'USDT',
+    'DEXT': 'USDT',
+    'DOS': 'USDT',
+    'GEEQ': 'USDT',
+    'LINKDOWN': 'USDT',
+    'LINKUP': 'USDT',
+    'XTZDOWN': 'USDT',
+    'XTZUP': 'USDT',
+    'STAKE': 'USDT',
+    'MCB': 'USDT',
+    'TRB': 'USDT',
+    'YFI': 'USDT',
+    'YAM': 'USDT',
+    'DEC-2': 'USDT',
+    'ORN': 'USDT',
+    'PERX': 'USDT',
+    'PRQ': 'USDT',
+    'RING': 'USDT',
+    'SBREE': 'USDT',
+    'YFII': 'USDT',
+    'BZRX': 'USDT',
+    'CREAM': 'USDT',
+    'ADEL': 'USDT',
+    'ANK': 'USDT',
+    'CORN': 'USDT',
+    'SAL': 'USDT',
+    'CRT': 'USDT',
+    'FSW': 'USDT',
+    'JFI': 'USDT',
+    'PEARL': 'USDT',
+    'TAI': 'USDT',
+    'YFL': 'USDT',
+    'TRUMPWIN': 'USDT',
+    'TRUMPLOSE': 'USDT',
+    'KLV': 'USDT',
+    'KRT': 'KRW',
+    'RVC': 'USDT',
+    'SDT': 'USDT',
+    'CHI': 'USDT',
+    'BAKE': 'BNB',
+    'BURGER': 'BNB',
+    'CAKE': 'BNB',
+    'BREE': 'USDT',
+    'GHST': 'USDT',
+    'MEXP': 'USDT',
+    'POLS': 'USDT',
+    'RARI': 'USDT',
+    'VALUE': 'USDT',
+    '$BASED': 'WETH',
+    'DPI': 'WETH',
+    'JRT': 'USDT',
+    'PICKLE': 'USDT',
+    'FILDOWN': 'USDT',
+    'FILUP': 'USDT',
+    'YFIDOWN': 'USDT',
+    'YFIUP': 'USDT',
+    'BOT': 'USDT',
+    'SG': 'USDT',
+    'SPARTA': 'BNB',
+    'MIR': 'USDC',
+    'NDX': 'WETH',
 }
-CRYPTOCOMPARE_SPECIAL_CASES = CRYPTOCOMPARE_SPECIAL_CASES_MAPPING.keys()
+CRYPTOCOMPARE_SPECIAL_CASES = frozenset(CRYPTOCOMPARE_SPECIAL_CASES_MAPPING)
 CRYPTOCOMPARE_HOURQUERYLIMIT = 2000
+# How many histohour queries to have in flight at once when backfilling a range
+CRYPTOCOMPARE_HISTOHOUR_CONCURRENCY = 4
+# After how many seconds to requery the coinlist (about a month)
+CRYPTOCOMPARE_COINLIST_CACHE_SECS = 2629800
+# How many daily historical prices to remember in memory
+CRYPTOCOMPARE_DAILY_PRICE_CACHE_SIZE = 8192
+# How many failed historical price queries to remember and for how long. A zero price
+# from cryptocompare means it has no price but can also come from a transient bug on
+# their side. So zero prices are never kept with the daily prices and only remembered
+# as missing for a short while.
+CRYPTOCOMPARE_MISSING_PRICE_CACHE_SIZE = 50000
+CRYPTOCOMPARE_MISSING_PRICE_CACHE_SECS = 3600
+
+# As described in the docs
+# https://min-api.cryptocompare.com/documentation?key=Other&cat=allCoinsWithContentEndpoint
+# This is not the entire list of assets in the system, so I am manually adding
+# here assets I am aware of that they already have historical data for in thei
+# cryptocompare system
+_CRYPTOCOMPARE_EXTRA_ASSETS = frozenset((
+    'DAO',
+    'USDT',
+    'VEN',
+    # This is Aircoin
+    'AIR*',
+    # This is SpendCoin (https://coinmarketcap.com/currencies/spendcoin/)
+    'SPND',
+    # This is eBitcoinCash (https://coinmarketcap.com/currencies/ebitcoin-cash/)
+    'EBCH',
+    # This is Educare (https://coinmarketcap.com/currencies/educare/)
+    'EKT',
+    # This is Knoxstertoken (https://coinmarketcap.com/currencies/knoxstertoken/)
+    'FKX',
+    # This is FNKOS (https://coinmarketcap.com/currencies/fnkos/)
+    'FNKOS',
+    # This is FansTime (https://coinmarketcap.com/currencies/fanstime/)
+    'FTI',
+    # This is Gene Source Code Chain
+    # (https://coinmarketcap.com/currencies/gene-source-code-chain/)
+    'GENE*',
+    # This is GazeCoin (https://coinmarketcap.com/currencies/gazecoin/)
+    'GZE',
+    # This is probaly HarmonyCoin (https://coinmarketcap.com/currencies/harmonycoin-hmc/)
+    'HMC*',
+    # This is IoTChain (https://coinmarketcap.com/currencies/iot-chain/)
+    'ITC',
+    # This is Luna Coin (https://coinmarketcap.com/currencies/luna-coin/)
+    'LUNA',
+    # This is MFTU (https://coinmarketcap.com/currencies/mainstream-for-the-underground/)
+    'MFTU',
+    # This is Nexxus (https://coinmarketcap.com/currencies/nexxus/)
+    'NXX',
+    # This is Owndata (https://coinmarketcap.com/currencies/owndata/)
+    'OWN',
+    # This is PiplCoin (https://coinmarketcap.com/currencies/piplcoin/)
+    'PIPL',
+    # This is PKG Token (https://coinmarketcap.com/currencies/pkg-token/)
+    'PKG',
+    # This is Quibitica https://coinmarketcap.com/currencies/qubitica/
+    'QBIT',
+    # This is DPRating https://coinmarketcap.com/currencies/dprating/
+    'RATING',
+    # This is RocketPool https://coinmarketcap.com/currencies/rocket-pool/
+    'RPL',
+    # This is SpeedMiningService (https://coinmarketcap.com/currencies/speed-mining-service/)
+    'SMS',
+    # This is SmartShare (https://coinmarketcap.com/currencies/smartshare/)
+    'SSP',
+    # This is ThoreCoin (https://coinmarketcap.com/currencies/thorecoin/)
+    'THR',
+    # This is Transcodium (https://coinmarketcap.com/currencies/transcodium/)
+    'TNS',
+))
+_EXTRA_ASSET_SENTINEL = object()
 
 METADATA_RE = re.compile('.*"start_time": *(.*), *"end_time": *(.*), "data".*')
+_HISTORY_ENTRY_FIELDS = itemgetter('time', 'low', 'high')
 
 
 class PriceHistoryEntry(NamedTuple):
@@ -163,10 +257,20 @@ class PriceHistoryEntry(NamedTuple):
 
 
 class PriceHistoryData(NamedTuple):
-    data: List[PriceHistoryEntry]
+    """The price history of a pair, kept as parallel columns of the entries' values"""
+    times: List[Timestamp]
+    lows: List[Price]
+    highs: List[Price]
     start_time: Timestamp
     end_time: Timestamp
 
+    def entries(self) -> List[PriceHistoryEntry]:
+        """Returns a list of all entries. Avoid it in hot paths, it copies the whole history"""
+        return [
+            PriceHistoryEntry(time=time, low=low, high=high)
+            for time, low, high in zip(self.times, self.lows, self.highs)
+        ]
+
 
 class HistoHourAssetData(NamedTuple):
     timestamp: Timestamp
@@ -183,35 +287,64 @@ CRYPTOCOMPARE_SPECIAL_HISTOHOUR_CASES: Dict[Asset, HistoHourAssetData] = {
 }
 
 
-def _dict_history_to_entries(data: List[Dict[str, Any]]) -> List[PriceHistoryEntry]:
-    """Turns a list of dict of history entries to a list of proper objects"""
-    return [
-        PriceHistoryEntry(
-            time=Timestamp(entry['time']),
-            low=Price(FVal(entry['low'])),
-            high=Price(FVal(entry['high'])),
-        ) for entry in data
-    ]
+def _history_columns(
+        times: Iterable[Any],
+        lows: Iterable[Any],
+        highs: Iterable[Any],
+) -> Tuple[List[Timestamp], List[Price], List[Price]]:
+    """Turns raw history columns into columns of proper objects"""
+    fval = FVal
+    return (
+        list(times),
+        [Price(fval(low)) for low in lows],
+        [Price(fval(high)) for high in highs],
+    )
+
+
+def _dict_history_to_columns(
+        data: List[Dict[str, Any]],
+) -> Tuple[List[Timestamp], List[Price], List[Price]]:
+    """Turns a list of dict of history entries to columns of proper objects
+
+    This runs for every entry of a cached pair (tens of thousands of them) so the
+    fields are extracted with a single itemgetter call per entry.
+    """
+    if len(data) == 0:
+        return [], [], []
+
+    times, lows, highs = zip(*map(_HISTORY_ENTRY_FIELDS, data))
+    return _history_columns(times, lows, highs)
 
 
 def _dict_history_to_data(data: Dict[str, Any]) -> PriceHistoryData:
-    """Turns a price history data dict entry into a proper object"""
+    """Turns a price history data dict entry into a proper object
+
+    The history can either be a list of entries or, as written in the cache files,
+    a dict of columns
+    """
+    history = data['data']
+    if isinstance(history, dict):
+        times, lows, highs = _history_columns(history['time'], history['low'], history['high'])
+    else:
+        times, lows, highs = _dict_history_to_columns(history)
     return PriceHistoryData(
-        data=_dict_history_to_entries(data['data']),
+        times=times,
+        lows=lows,
+        highs=highs,
         start_time=Timestamp(data['start_time']),
         end_time=Timestamp(data['end_time']),
     )
 
 
-def _multiply_str_nums(a: str, b: str) -> str:
-    """Multiplies two string numbers and returns the result as a string"""
-    return str(FVal(a) * FVal(b))
+@lru_cache(maxsize=2048, typed=True)
+def _cached_fval(num: str) -> FVal:
+    """Memoized FVal parsing. Histohour prices repeat a lot, especially for stablecoins"""
+    return FVal(num)
 
 
-def pairwise(iterable: Iterable[Any]) -> Iterator:
-    "s -> (s0, s1), (s2, s3), (s4, s5), ..."
-    a = iter(iterable)
-    return zip(a, a)
+def _multiply_str_nums(a: str, b: str) -> str:
+    """Multiplies two string numbers and returns the result as a string"""
+    return str(_cached_fval(a) * _cached_fval(b))
 
 
 def _check_hourly_data_sanity(
@@ -224,9 +357,18 @@ def _check_hourly_data_sanity(
 
     If not then a RemoteError is raised
     """
-    index = 0
-    for n1, n2 in pairwise(data):
-        diff = n2['time'] - n1['time']
+    if len(data) == 0:
+        return
+
+    times = [entry['time'] for entry in data]
+    start = times[0]
+    # Fast path: compare against the expected hourly range in one C-level list comparison
+    if times == list(range(start, start + 3600 * len(times), 3600)):
+        return
+
+    # Slow path, only to locate the first offending pair for the error message
+    for index in range(len(times) - 1):
+        diff = times[index + 1] - times[index]
         if diff != 3600:
             raise RemoteError(
                 'Unexpected data format in cryptocompare query_endpoint_histohour. '
@@ -234,7 +376,82 @@ def _check_hourly_data_sanity(
                     index, index + 1, from_asset.symbol, to_asset.symbol, diff),
             )
 
-        index += 2
+
+def _histohour_query_windows(
+        from_timestamp: Timestamp,
+        to_timestamp: Timestamp,
+) -> Iterator[Timestamp]:
+    """Yields the to_timestamp of each histohour query needed to go backwards in time
+    from from_timestamp until to_timestamp is covered"""
+    end_date = from_timestamp
+    while True:
+        yield end_date
+        end_date = Timestamp(end_date - (CRYPTOCOMPARE_HOURQUERYLIMIT * 3600))
+        if end_date - to_timestamp <= 3600:
+            return
+
+
+@lru_cache(maxsize=None)
+def _special_cases_mapping() -> Dict[Asset, Asset]:
+    """Lazily resolves the special cases mapping to assets the first time it's needed"""
+    return {
+        Asset(identifier): Asset(intermediate)
+        for identifier, intermediate in CRYPTOCOMPARE_SPECIAL_CASES_MAPPING.items()
+    }
+
+
+def _call_capturing_error(
+        method: Callable[..., Any],
+        *args: Any,
+        **kwargs: Any,
+) -> Tuple[Any, Optional[Exception]]:
+    """Calls method and returns its result or the exception it raised
+
+    Meant to run inside a greenlet. An exception escaping a greenlet is printed as
+    a traceback by the gevent hub, so instead it's handed back to be raised by
+    whoever waits for the greenlet.
+    """
+    try:
+        return method(*args, **kwargs), None
+    except Exception as e:  # pylint: disable=broad-except
+        return None, e
+
+
+def _trim_histohour_window_data(
+        data: List[Dict[str, Any]],
+        window_end: Timestamp,
+        time_from: Timestamp,
+        oldest_time: Optional[Timestamp],
+) -> List[Dict[str, Any]]:
+    """Trims the data of the histohour response for the window ending at window_end so
+    that it can be prepended to the already collected, newer, data whose oldest entry
+    is at oldest_time.
+
+    May raise:
+    - RemoteError if the data does not have the expected format
+    """
+    window_start = Timestamp(window_end - (CRYPTOCOMPARE_HOURQUERYLIMIT * 3600))
+    if window_start != time_from:
+        # If we get more than we needed, since we are close to the now_ts
+        # then skip all the already included entries
+        diff = abs(window_start - time_from)
+        # If the start date has less than 3600 secs difference from previous
+        # end date then do nothing. If it has more skip all already included entries
+        if diff >= 3600:
+            if data[diff // 3600]['time'] != window_start:
+                raise RemoteError(
+                    'Unexpected data format in cryptocompare query_endpoint_histohour. '
+                    'Expected to find the previous date timestamp during '
+                    'cryptocompare historical data fetching',
+                )
+            # just add only the part from the previous timestamp and on
+            data = data[diff // 3600:]
+
+    # If last time slot and first new are the same, skip the first new slot
+    if oldest_time is not None and oldest_time == data[-1]['time']:
+        data = data[:-1]
+
+    return data
 
 
 def _get_cache_key(from_asset: Asset, to_asset: Asset) -> Optional[PairCacheKey]:
@@ -265,7 +482,14 @@ def _write_history_data_in_file(
         # start and end time to come before the data in the file
         history_dict['start_time'] = start_ts
         history_dict['end_time'] = end_ts
-        history_dict['data'] = data
+        # Store only the columns we use and without repeating the keys for each entry.
+        # Makes the files a lot smaller and faster to load. Older files with a list of
+        # full entries are still readable and get rewritten in this format on update.
+        history_dict['data'] = {
+            'time': [entry['time'] for entry in data],
+            'low': [entry['low'] for entry in data],
+            'high': [entry['high'] for entry in data],
+        }
         outfile.write(rlk_jsondumps(history_dict))
 
 
@@ -275,23 +499,52 @@ class Cryptocompare(ExternalServiceWithApiKey):
         self.data_directory = data_directory
         self.price_history: Dict[PairCacheKey, PriceHistoryData] = {}
         self.price_history_file: Dict[PairCacheKey, Path] = {}
+        # Daily prices of past days never change so remember the ones we queried
+        self.daily_price_cache: 'OrderedDict[Tuple[str, str, int], Price]' = OrderedDict()
+        # Historical prices we failed to find mapped to when we failed to find them
+        self.missing_prices: 'OrderedDict[Tuple[str, str, Timestamp], Timestamp]' = OrderedDict()
+        # Timestamp the coinlist was queried at and the coinlist itself
+        self.coinlist_cache: Optional[Tuple[Timestamp, Dict[str, Any]]] = None
         self.session = requests.session()
+        # Keep enough pooled keep-alive connections for the concurrent histohour queries
+        # and let urllib3 retry connection errors and gateway failures. Read timeouts are
+        # not retried so that a hung endpoint fails after a single timeout. The retry loop
+        # in _api_query then only needs to care about rate limiting.
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=3,
+                read=0,
+                backoff_factor=0.3,
+                status_forcelist=(502, 503, 504),
+            ),
+        )
+        self.session.mount('https://', adapter)
         self.session.headers.update({'User-Agent': 'rotkehlchen'})
         self.last_histohour_query_ts = 0
         self.last_rate_limit = 0
 
         price_history_dir = get_or_make_price_history_dir(data_directory)
         # Check the data folder and remember the filenames of any cached history
-        prefix = os.path.join(str(price_history_dir), PRICE_HISTORY_FILE_PREFIX)
-        prefix = prefix.replace('\\', '\\\\')
-        regex = re.compile(prefix + r'(.*)\.json')
+        legacy_files: Dict[PairCacheKey, Path] = {}
+        with os.scandir(price_history_dir) as it:
+            for entry in it:
+                name = entry.name
+                if not name.endswith('.json') or not entry.is_file():
+                    continue
+
+                if name.startswith(PRICE_HISTORY_FILE_PREFIX):
+                    cache_key = PairCacheKey(name[len(PRICE_HISTORY_FILE_PREFIX):-len('.json')])
+                    self.price_history_file[cache_key] = Path(entry.path)
+                elif name.startswith(LEGACY_PRICE_HISTORY_FILE_PREFIX):
+                    cache_key = PairCacheKey(
+                        name[len(LEGACY_PRICE_HISTORY_FILE_PREFIX):-len('.json')],
+                    )
+                    legacy_files[cache_key] = Path(entry.path)
 
-        for file_ in price_history_dir.rglob(PRICE_HISTORY_FILE_PREFIX + '*.json'):
-            file_str = str(file_).replace('\\\\', '\\')
-            match = regex.match(file_str)
-            assert match
-            cache_key = PairCacheKey(match.group(1))
-            self.price_history_file[cache_key] = file_
+        for cache_key, path in legacy_files.items():
+            self.price_history_file.setdefault(cache_key, path)
 
     def can_query_history(
             self,
@@ -305,19 +558,21 @@ class Cryptocompare(ExternalServiceWithApiKey):
         - Existence of a cached price
         - Last rate limit
         """
-        cached_data = self._got_cached_data_at_timestamp(
+        got_cached_data = self._cache_covers_timestamp(
             from_asset=from_asset,
             to_asset=to_asset,
             timestamp=timestamp,
         )
         rate_limited = self.rate_limited_in_last(seconds)
-        can_query = cached_data is not None or not rate_limited
-        logger.debug(
-            f'{"Will" if can_query else "Will not"} query '
-            f'Cryptocompare history for {from_asset.identifier} -> '
-            f'{to_asset.identifier} @ {timestamp}. Cached data: {cached_data is not None}'
-            f' rate_limited in last {seconds} seconds: {rate_limited}',
-        )
+        can_query = got_cached_data or not rate_limited
+        # This runs for every historical price query so don't format the message for nothing
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f'{"Will" if can_query else "Will not"} query '
+                f'Cryptocompare history for {from_asset.identifier} -> '
+                f'{to_asset.identifier} @ {timestamp}. Cached data: {got_cached_data}'
+                f' rate_limited in last {seconds} seconds: {rate_limited}',
+            )
         return can_query
 
     def rate_limited_in_last(self, seconds: int = CRYPTOCOMPARE_RATE_LIMIT_WAIT_TIME) -> bool:
@@ -347,47 +602,51 @@ class Cryptocompare(ExternalServiceWithApiKey):
         querystr = f'https://min-api.cryptocompare.com/data/{path}'
         log.debug('Querying cryptocompare', url=querystr)
         api_key = self._get_api_key()
-        if api_key:
-            querystr += '?' if '?' not in querystr else '&'
-            querystr += f'api_key={api_key}'
+        # requests appends the params to any query string already in the path
+        params = {'api_key': api_key} if api_key else None
 
         tries = CRYPTOCOMPARE_QUERY_RETRY_TIMES
         while tries >= 0:
             try:
-                response = self.session.get(querystr)
+                response = self.session.get(
+                    querystr,
+                    params=params,
+                    timeout=DEFAULT_TIMEOUT_TUPLE,
+                )
             except requests.exceptions.RequestException as e:
                 raise RemoteError(f'Cryptocompare API request failed due to {str(e)}') from e
 
+            # backoff and retry 3 times =  1 + 1.5 + 3 = at most 5.5 secs
+            # Failing is also fine, since all calls have secondary data sources
+            # for example coingecko. The rate limit message is detected on the raw
+            # bytes so that we don't parse the JSON of responses we will retry anyway
+            if RATE_LIMIT_MSG_BYTES in response.content:
+                self.last_rate_limit = ts_now()
+                if tries >= 1:
+                    backoff_seconds = 3 / tries
+                    log.debug(
+                        f'Got rate limited by cryptocompare. '
+                        f'Backing off for {backoff_seconds}',
+                    )
+                    gevent.sleep(backoff_seconds)
+                    tries -= 1
+                    continue
+
+                # else
+                log.debug(
+                    f'Got rate limited by cryptocompare and did not manage to get a '
+                    f'request through even after {CRYPTOCOMPARE_QUERY_RETRY_TIMES} '
+                    f'incremental backoff retries',
+                )
+
             try:
-                json_ret = jsonloads_dict(response.text)
-            except JSONDecodeError as e:
+                json_ret = jsonloads_dict(response.content)
+            except (JSONDecodeError, UnicodeDecodeError) as e:
                 raise RemoteError(
                     f'Cryptocompare returned invalid JSON response: {response.text}',
                 ) from e
 
             try:
-                # backoff and retry 3 times =  1 + 1.5 + 3 = at most 5.5 secs
-                # Failing is also fine, since all calls have secondary data sources
-                # for example coingecko
-                if json_ret.get('Message', None) == RATE_LIMIT_MSG:
-                    self.last_rate_limit = ts_now()
-                    if tries >= 1:
-                        backoff_seconds = 3 / tries
-                        log.debug(
-                            f'Got rate limited by cryptocompare. '
-                            f'Backing off for {backoff_seconds}',
-                        )
-                        gevent.sleep(backoff_seconds)
-                        tries -= 1
-                        continue
-
-                    # else
-                    log.debug(
-                        f'Got rate limited by cryptocompare and did not manage to get a '
-                        f'request through even after {CRYPTOCOMPARE_QUERY_RETRY_TIMES} '
-                        f'incremental backoff retries',
-                    )
-
                 if json_ret.get('Response', 'Success') != 'Success':
                     error_message = f'Failed to query cryptocompare for: "{querystr}"'
                     if 'Message' in json_ret:
@@ -428,19 +687,33 @@ class Cryptocompare(ExternalServiceWithApiKey):
         For some assets cryptocompare can only figure out the price via intermediaries.
         This function takes care of these special cases."""
         method = getattr(self, method_name)
-        intermediate_asset = CRYPTOCOMPARE_SPECIAL_CASES_MAPPING[from_asset]
-        result1 = method(
+        intermediate_asset = _special_cases_mapping()[from_asset]
+        # The two legs are independent queries so let them run concurrently
+        greenlet1 = gevent.spawn(
+            _call_capturing_error,
+            method,
             from_asset=from_asset,
             to_asset=intermediate_asset,
             handling_special_case=True,
             **kwargs,
         )
-        result2 = method(
+        greenlet2 = gevent.spawn(
+            _call_capturing_error,
+            method,
             from_asset=intermediate_asset,
             to_asset=to_asset,
             handling_special_case=True,
             **kwargs,
         )
+        try:
+            for greenlet in gevent.iwait([greenlet1, greenlet2]):
+                error = greenlet.value[1]
+                if error is not None:
+                    raise error
+        finally:
+            # If one leg failed don't leave the other one querying in the background
+            gevent.killall([greenlet1, greenlet2])
+        result1, result2 = greenlet1.value[0], greenlet2.value[0]
         result: Any
         if method_name == 'query_endpoint_histohour':
             result = {
@@ -448,23 +721,18 @@ class Cryptocompare(ExternalServiceWithApiKey):
                 'TimeFrom': result1['TimeFrom'],
                 'TimeTo': result1['TimeTo'],
             }
-            result1 = result1['Data']
-            result2 = result2['Data']
-            data = []
-            for idx, entry in enumerate(result1):
-                entry2 = result2[idx]
-                data.append({
-                    'time': entry['time'],
-                    'high': _multiply_str_nums(entry['high'], entry2['high']),
-                    'low': _multiply_str_nums(entry['low'], entry2['low']),
-                    'open': _multiply_str_nums(entry['open'], entry2['open']),
-                    'volumefrom': entry['volumefrom'],
-                    'volumeto': entry['volumeto'],
-                    'close': _multiply_str_nums(entry['close'], entry2['close']),
-                    'conversionType': entry['conversionType'],
-                    'conversionSymbol': entry['conversionSymbol'],
-                })
-            result['Data'] = data
+            multiply = _multiply_str_nums
+            result['Data'] = [{
+                'time': entry1['time'],
+                'high': multiply(entry1['high'], entry2['high']),
+                'low': multiply(entry1['low'], entry2['low']),
+                'open': multiply(entry1['open'], entry2['open']),
+                'volumefrom': entry1['volumefrom'],
+                'volumeto': entry1['volumeto'],
+                'close': multiply(entry1['close'], entry2['close']),
+                'conversionType': entry1['conversionType'],
+                'conversionSymbol': entry1['conversionSymbol'],
+            } for entry1, entry2 in zip(result1['Data'], result2['Data'])]
             return result
 
         if method_name in ('query_current_price', 'query_endpoint_pricehistorical'):
@@ -487,7 +755,8 @@ class Cryptocompare(ExternalServiceWithApiKey):
         - May raise PriceQueryUnsupportedAsset if from/to assets are not known to cryptocompare
         """
         special_asset = (
-            from_asset in CRYPTOCOMPARE_SPECIAL_CASES or to_asset in CRYPTOCOMPARE_SPECIAL_CASES
+            from_asset.identifier in CRYPTOCOMPARE_SPECIAL_CASES or
+            to_asset.identifier in CRYPTOCOMPARE_SPECIAL_CASES
         )
         if special_asset and not handling_special_case:
             return self._special_case_handling(
@@ -524,7 +793,8 @@ class Cryptocompare(ExternalServiceWithApiKey):
         - May raise PriceQueryUnsupportedAsset if from/to assets are not known to cryptocompare
         """
         special_asset = (
-            from_asset in CRYPTOCOMPARE_SPECIAL_CASES or to_asset in CRYPTOCOMPARE_SPECIAL_CASES
+            from_asset.identifier in CRYPTOCOMPARE_SPECIAL_CASES or
+            to_asset.identifier in CRYPTOCOMPARE_SPECIAL_CASES
         )
         if special_asset and not handling_special_case:
             return self._special_case_handling(
@@ -567,7 +837,8 @@ class Cryptocompare(ExternalServiceWithApiKey):
             timestamp=timestamp,
         )
         special_asset = (
-            from_asset in CRYPTOCOMPARE_SPECIAL_CASES or to_asset in CRYPTOCOMPARE_SPECIAL_CASES
+            from_asset.identifier in CRYPTOCOMPARE_SPECIAL_CASES or
+            to_asset.identifier in CRYPTOCOMPARE_SPECIAL_CASES
         )
         if special_asset and not handling_special_case:
             return self._special_case_handling(
@@ -587,6 +858,14 @@ class Cryptocompare(ExternalServiceWithApiKey):
             f'pricehistorical?fsym={cc_from_asset_symbol}&tsyms={cc_to_asset_symbol}'
             f'&ts={timestamp}'
         )
+        # pricehistorical returns the price of the whole (UTC) day of the timestamp
+        day = timestamp // DAY_IN_SECONDS
+        cache_key = (from_asset.identifier, to_asset.identifier, day)
+        cached_price = self.daily_price_cache.get(cache_key, None)
+        if cached_price is not None:
+            self.daily_price_cache.move_to_end(cache_key)
+            return cached_price
+
         if to_asset == 'BTC':
             query_path += '&tryConversion=false'
         result = self._api_query(query_path)
@@ -598,7 +877,12 @@ class Cryptocompare(ExternalServiceWithApiKey):
         ):
             return Price(ZERO)
 
-        return Price(FVal(result[cc_from_asset_symbol][cc_to_asset_symbol]))
+        price = Price(FVal(result[cc_from_asset_symbol][cc_to_asset_symbol]))
+        if day < ts_now() // DAY_IN_SECONDS:  # the current day's price can still change
+            if len(self.daily_price_cache) >= CRYPTOCOMPARE_DAILY_PRICE_CACHE_SIZE:
+                self.daily_price_cache.popitem(last=False)
+            self.daily_price_cache[cache_key] = price
+        return price
 
     def get_cached_data(self, from_asset: Asset, to_asset: Asset) -> Optional[PriceHistoryData]:
         """Get the cached data for a pair if they exist. This reads the entire file,
@@ -613,10 +897,12 @@ class Cryptocompare(ExternalServiceWithApiKey):
 
         if cache_key not in self.price_history:
             try:
-                with open(self.price_history_file[cache_key], 'r') as f:
+                # Read raw bytes and let the json decoder handle them directly. Avoids
+                # the text layer decoding of the whole (potentially huge) file first
+                with open(self.price_history_file[cache_key], 'rb') as f:
                     data = jsonloads_dict(f.read())
-                    self.price_history[cache_key] = _dict_history_to_data(data)
-            except (OSError, JSONDecodeError):
+                self.price_history[cache_key] = _dict_history_to_data(data)
+            except (OSError, JSONDecodeError, UnicodeDecodeError, KeyError):
                 return None
 
         return self.price_history[cache_key]
@@ -685,56 +971,71 @@ class Cryptocompare(ExternalServiceWithApiKey):
 
         return None
 
+    def _cache_covers_timestamp(
+            self,
+            from_asset: Asset,
+            to_asset: Asset,
+            timestamp: Timestamp,
+    ) -> bool:
+        """Check if the cached price history of the pair covers the timestamp
+
+        Only the cached time range is checked. For a cache not yet loaded in memory that
+        only reads the start of the file, so the entire file is only loaded if its header
+        can't be read. Loading the cache to extend it is left to get_historical_data().
+        """
+        metadata = self.get_cached_data_metadata(from_asset, to_asset)
+        if metadata is None:
+            return self._got_cached_data_at_timestamp(
+                from_asset=from_asset,
+                to_asset=to_asset,
+                timestamp=timestamp,
+            ) is not None
+
+        return metadata[0] <= timestamp < metadata[1]
+
     @staticmethod
     def _retrieve_price_from_data(
-            data: Optional[List[PriceHistoryEntry]],
+            data: Optional[PriceHistoryData],
             from_asset: Asset,
             to_asset: Asset,
             timestamp: Timestamp,
     ) -> Price:
-        """Reads historical price data list returned from cryptocompare histohour
+        """Reads historical price data returned from cryptocompare histohour
         or cache and returns a price.
 
         If nothing is found it returns Price(0). This can also happen if cryptocompare
         returns a list of 0s for the timerange.
         """
         price = Price(ZERO)
-        if data is None or len(data) == 0:
+        if data is None or len(data.times) == 0:
             return price
 
-        # all data are sorted and timestamps are always increasing by 1 hour
-        # find the closest entry to the provided timestamp
-        if timestamp >= data[0].time:
-            index_in_bounds = True
-            # convert_to_int can't raise here due to its input
-            index = convert_to_int((timestamp - data[0].time) / 3600, accept_only_exact=False)
-            if index > len(data) - 1:  # index out of bounds
-                # Try to see if index - 1 is there and if yes take it
-                if index > len(data):
-                    index = index - 1
-                else:  # give up. This happened: https://github.com/rotki/rotki/issues/1534
-                    log.error(
-                        f'Expected data index in cryptocompare historical hour price '
-                        f'not found. Queried price of: {from_asset.identifier} in '
-                        f'{to_asset.identifier} at {timestamp}. Data '
-                        f'index: {index}. Length of returned data: {len(data)}. '
-                        f'https://github.com/rotki/rotki/issues/1534. Attempting other methods...',
-                    )
-                    index_in_bounds = False
+        times = data.times
+        if timestamp < times[0]:
+            # no price found in the historical data from/to asset, try alternatives
+            return price
 
-            if index_in_bounds:
-                diff = abs(data[index].time - timestamp)
-                if index + 1 <= len(data) - 1:
-                    diff_p1 = abs(data[index + 1].time - timestamp)
-                    if diff_p1 < diff:
-                        index = index + 1
+        if timestamp - times[-1] >= 3600:
+            # This happened: https://github.com/rotki/rotki/issues/1534
+            log.error(
+                f'Expected data index in cryptocompare historical hour price '
+                f'not found. Queried price of: {from_asset.identifier} in '
+                f'{to_asset.identifier} at {timestamp}. Last data entry is at '
+                f'{times[-1]}. Length of returned data: {len(times)}. '
+                f'https://github.com/rotki/rotki/issues/1534. Attempting other methods...',
+            )
+            return price
 
-                if data[index].high is not None and data[index].low is not None:
-                    price = Price((data[index].high + data[index].low) / 2)
+        # all data are sorted so find the closest entry to the provided timestamp
+        index = bisect_left(times, timestamp)
+        if index == len(times) or (
+            index > 0 and times[index] - timestamp >= timestamp - times[index - 1]
+        ):
+            index -= 1
 
-        else:
-            # no price found in the historical data from/to asset, try alternatives
-            price = Price(ZERO)
+        high, low = data.highs[index], data.lows[index]
+        if high is not None and low is not None:
+            price = Price((high + low) / 2)
 
         return price
 
@@ -744,7 +1045,7 @@ class Cryptocompare(ExternalServiceWithApiKey):
             to_asset: Asset,
             from_timestamp: Timestamp,
             to_timestamp: Timestamp,
-    ) -> Deque[Dict[str, Any]]:
+    ) -> List[Dict[str, Any]]:
         """Query histohour data from cryptocompare for a time range going backwards in time
 
         Will stop when to_timestamp is reached OR when no more prices are returned
@@ -758,63 +1059,76 @@ class Cryptocompare(ExternalServiceWithApiKey):
         msg = '_get_histohour_data_for_range from_timestamp should be bigger than to_timestamp'
         assert from_timestamp >= to_timestamp, msg
 
-        calculated_history: Deque[Dict[str, Any]] = deque()
-        end_date = from_timestamp
-        while True:
+        def query_window(window_end: Timestamp) -> Tuple[Timestamp, Any, Optional[Exception]]:
             log.debug(
                 'Querying cryptocompare for hourly historical price',
                 from_asset=from_asset,
                 to_asset=to_asset,
                 cryptocompare_hourquerylimit=CRYPTOCOMPARE_HOURQUERYLIMIT,
-                end_date=end_date,
+                end_date=window_end,
             )
-            resp = self.query_endpoint_histohour(
+            resp, error = _call_capturing_error(
+                self.query_endpoint_histohour,
                 from_asset=from_asset,
                 to_asset=to_asset,
                 limit=2000,
-                to_timestamp=end_date,
+                to_timestamp=window_end,
             )
-            if all(FVal(x['close']) == ZERO for x in resp['Data']):
-                # all prices zero Means we have reached the end of available prices
-                break
-
-            end_date = Timestamp(end_date - (CRYPTOCOMPARE_HOURQUERYLIMIT * 3600))
-            if end_date != resp['TimeFrom']:
-                # If we get more than we needed, since we are close to the now_ts
-                # then skip all the already included entries
-                diff = abs(end_date - resp['TimeFrom'])
-                # If the start date has less than 3600 secs difference from previous
-                # end date then do nothing. If it has more skip all already included entries
-                if diff >= 3600:
-                    if resp['Data'][diff // 3600]['time'] != end_date:
-                        raise RemoteError(
-                            'Unexpected data format in cryptocompare query_endpoint_histohour. '
-                            'Expected to find the previous date timestamp during '
-                            'cryptocompare historical data fetching',
-                        )
-                    # just add only the part from the previous timestamp and on
-                    resp['Data'] = resp['Data'][diff // 3600:]
-
-            # If last time slot and first new are the same, skip the first new slot
-            last_entry_equal_to_first = (
-                len(calculated_history) != 0 and
-                calculated_history[0]['time'] == resp['Data'][-1]['time']
-            )
-            if last_entry_equal_to_first:
-                resp['Data'] = resp['Data'][:-1]
-            if len(calculated_history) != 0:
-                calculated_history.extendleft(reversed(resp['Data']))
-            else:
-                calculated_history = deque(resp['Data'])
-
-            if end_date - to_timestamp <= 3600:
-                # Ending the loop query. Also pop any extra timestamps
-                while (
-                        len(calculated_history) != 0 and
-                        calculated_history[0]['time'] <= to_timestamp
-                ):
-                    calculated_history.popleft()
-                break
+            return window_end, resp, error
+
+        # Each response's data is kept as a separate chunk, each one older than the
+        # previous, and they are all joined once at the end
+        chunks: List[List[Dict[str, Any]]] = []
+        oldest_time = None
+        reached_to_timestamp = done = False
+        windows = _histohour_query_windows(from_timestamp, to_timestamp)
+        # The queries of each batch run concurrently but the responses are processed
+        # in order. Rate limiting is still handled per query inside _api_query
+        pool = Pool(size=CRYPTOCOMPARE_HISTOHOUR_CONCURRENCY)
+        try:
+            while not done:
+                batch = list(islice(windows, CRYPTOCOMPARE_HISTOHOUR_CONCURRENCY))
+                if len(batch) == 0:
+                    break
+
+                for window_end, resp, error in pool.imap(query_window, batch):
+                    if error is not None:
+                        raise error
+
+                    data = resp['Data']
+                    if all(FVal(x['close']) == ZERO for x in data):
+                        # all prices zero Means we have reached the end of available prices
+                        done = True
+                        break
+
+                    data = _trim_histohour_window_data(
+                        data=data,
+                        window_end=window_end,
+                        time_from=resp['TimeFrom'],
+                        oldest_time=oldest_time,
+                    )
+                    if len(data) != 0:
+                        chunks.append(data)
+                        oldest_time = data[0]['time']
+
+                    window_start = window_end - (CRYPTOCOMPARE_HOURQUERYLIMIT * 3600)
+                    if window_start - to_timestamp <= 3600:
+                        reached_to_timestamp = done = True
+                        break
+        finally:
+            # Don't leave queries of an abandoned batch running in the background
+            pool.kill()
+
+        calculated_history = list(chain.from_iterable(reversed(chunks)))
+        if reached_to_timestamp:
+            # Ending the loop query. Also pop any extra timestamps
+            start_index = 0
+            while (
+                    start_index < len(calculated_history) and
+                    calculated_history[start_index]['time'] <= to_timestamp
+            ):
+                start_index += 1
+            del calculated_history[:start_index]
 
         return calculated_history
 
@@ -847,6 +1161,15 @@ class Cryptocompare(ExternalServiceWithApiKey):
 
         return cache_data
 
+    def _delete_cache_files(self, cache_key: PairCacheKey) -> None:
+        """Deletes the cache file of the pair along with any legacy one"""
+        price_history_dir = get_or_make_price_history_dir(self.data_directory)
+        for prefix in (PRICE_HISTORY_FILE_PREFIX, LEGACY_PRICE_HISTORY_FILE_PREFIX):
+            try:
+                (price_history_dir / f'{prefix}{cache_key}.json').unlink()
+            except FileNotFoundError:  # TODO: In python 3.8 we can add missing_ok=True to unlink  # noqa: E501
+                pass
+
     def delete_cache(self, from_asset: Asset, to_asset: Asset) -> None:
         """Deletes a cache if it exists. Does nothing if it does not"""
         cache_key = _get_cache_key(from_asset=from_asset, to_asset=to_asset)
@@ -854,12 +1177,7 @@ class Cryptocompare(ExternalServiceWithApiKey):
             return
 
         self.price_history.pop(cache_key, None)
-        filename = self.price_history_file.get(cache_key, None)
-        if filename:
-            try:
-                filename.unlink()
-            except FileNotFoundError:  # TODO: In python 3.8 we can add missing_ok=True to unlink  # noqa: E501
-                pass
+        self._delete_cache_files(cache_key)
 
     def create_cache(
             self,
@@ -879,12 +1197,12 @@ class Cryptocompare(ExternalServiceWithApiKey):
         now = ts_now()
 
         # If we got cached data for up to 1 hour ago there is no point doing anything
-        cached_data = self._got_cached_data_at_timestamp(
+        got_cached_data = self._cache_covers_timestamp(
             from_asset=from_asset,
             to_asset=to_asset,
             timestamp=Timestamp(now - 3600),
         )
-        if cached_data and not purge_old:
+        if got_cached_data and not purge_old:
             log.debug(
                 'Did not create new cache since we got cache until 1 hour ago',
                 from_asset=from_asset,
@@ -895,12 +1213,8 @@ class Cryptocompare(ExternalServiceWithApiKey):
         if purge_old:
             cache_key = _get_cache_key(from_asset=from_asset, to_asset=to_asset)
             if cache_key and cache_key in self.price_history_file:
-                filename = self.price_history_file[cache_key]
                 self.price_history.pop(cache_key, None)
-                try:
-                    filename.unlink()
-                except FileNotFoundError:  # TODO: In python 3.8 we can add missing_ok=True to unlink  # noqa: E501
-                    pass
+                self._delete_cache_files(cache_key)
 
         self.get_historical_data(
             from_asset=from_asset,
@@ -915,11 +1229,12 @@ class Cryptocompare(ExternalServiceWithApiKey):
             to_asset: Asset,
             timestamp: Timestamp,
             only_check_cache: bool,
-    ) -> Optional[List[PriceHistoryEntry]]:
+    ) -> Optional[PriceHistoryData]:
         """
         Get historical hour price data from cryptocompare
 
-        Returns a sorted list of price entries.
+        Returns the price history of the pair sorted by time, or None if cryptocompare
+        has no prices for it.
 
         If only_check_cache is True then if the data is not cached locally this will return None
 
@@ -939,7 +1254,7 @@ class Cryptocompare(ExternalServiceWithApiKey):
             timestamp=timestamp,
         )
         if cached_data is not None:
-            return cached_data.data
+            return cached_data
 
         if only_check_cache:
             return None
@@ -952,8 +1267,11 @@ class Cryptocompare(ExternalServiceWithApiKey):
         # save time at start of the query, in case the query does not complete due to rate limit
         self.last_histohour_query_ts = now_ts
         if cache_key in self.price_history:
-            old_data = self.price_history[cache_key].data
-            transformed_old_data = deque([x._asdict() for x in old_data])
+            old_data = self.price_history[cache_key]
+            transformed_old_data = [
+                {'time': time, 'low': low, 'high': high}
+                for time, low, high in zip(old_data.times, old_data.lows, old_data.highs)
+            ]
             if timestamp > self.price_history[cache_key].end_time:
                 # We have a cache but the requested timestamp does not hit it
                 new_data = self._get_histohour_data_for_range(
@@ -963,11 +1281,11 @@ class Cryptocompare(ExternalServiceWithApiKey):
                     to_timestamp=self.price_history[cache_key].end_time,
                 )
                 if len(new_data) == 0:
-                    new_history = transformed_old_data
+                    calculated_history = transformed_old_data
                 else:
-                    if len(old_data) != 0 and old_data[-1].time == new_data[0]['time']:
+                    if len(old_data.times) != 0 and old_data.times[-1] == new_data[0]['time']:
                         transformed_old_data.pop()
-                    new_history = transformed_old_data + new_data
+                    calculated_history = transformed_old_data + new_data
 
             else:
                 # only other possibility, timestamp < cached start_time
@@ -979,24 +1297,22 @@ class Cryptocompare(ExternalServiceWithApiKey):
                     to_timestamp=Timestamp(0),
                 )
                 if len(new_data) == 0:
-                    new_history = transformed_old_data
+                    calculated_history = transformed_old_data
                 else:
-                    if len(old_data) != 0 and new_data[-1]['time'] == old_data[0].time:
+                    if len(old_data.times) != 0 and new_data[-1]['time'] == old_data.times[0]:
                         new_data.pop()
-                    new_history = new_data + transformed_old_data
-
-            calculated_history = list(new_history)
+                    calculated_history = new_data + transformed_old_data
 
         else:
-            calculated_history = list(self._get_histohour_data_for_range(
+            calculated_history = self._get_histohour_data_for_range(
                 from_asset=from_asset,
                 to_asset=to_asset,
                 from_timestamp=now_ts,
                 to_timestamp=Timestamp(0),
-            ))
+            )
 
         if len(calculated_history) == 0:
-            return []  # empty list means we found nothing
+            return None  # we found nothing
 
         # Let's always check for data sanity for the hourly prices.
         _check_hourly_data_sanity(calculated_history, from_asset, to_asset)
@@ -1026,8 +1342,12 @@ class Cryptocompare(ExternalServiceWithApiKey):
         }
         self.price_history_file[cache_key] = filename
         self.price_history[cache_key] = _dict_history_to_data(data_including_time)
+        # The new data may contain prices of this pair we previously failed to find
+        pair = (from_asset.identifier, to_asset.identifier)
+        for missing_key in [x for x in self.missing_prices if x[:2] == pair]:
+            del self.missing_prices[missing_key]
         self.last_histohour_query_ts = ts_now()  # also save when last query finished
-        return self.price_history[cache_key].data
+        return self.price_history[cache_key]
 
     @staticmethod
     def _check_and_get_special_histohour_price(
@@ -1065,6 +1385,18 @@ class Cryptocompare(ExternalServiceWithApiKey):
                 )
         return price
 
+    @staticmethod
+    def _raise_no_price(from_asset: Asset, to_asset: Asset, timestamp: Timestamp) -> NoReturn:
+        raise NoPriceForGivenTimestamp(
+            from_asset=from_asset,
+            to_asset=to_asset,
+            date=timestamp_to_date(
+                timestamp,
+                formatstr='%d/%m/%Y, %H:%M:%S',
+                treat_as_local=True,
+            ),
+        )
+
     def query_historical_price(
             self,
             from_asset: Asset,
@@ -1078,7 +1410,8 @@ class Cryptocompare(ExternalServiceWithApiKey):
         This tries to:
         1. Find cached cryptocompare values and return them
         2. If none exist at the moment try the normal historical price endpoint
-        3. Else fail
+        3. Else fail and remember the failure for a while so that the same
+        query fails fast without querying cryptocompare again
 
         May raise:
         - PriceQueryUnsupportedAsset if from/to asset is known to miss from cryptocompare
@@ -1087,6 +1420,13 @@ class Cryptocompare(ExternalServiceWithApiKey):
         - RemoteError if there is a problem reaching the cryptocompare server
         or with reading the response returned by the server
         """
+        missing_key = (from_asset.identifier, to_asset.identifier, timestamp)
+        missing_since = self.missing_prices.get(missing_key, None)
+        if missing_since is not None:
+            if ts_now() - missing_since < CRYPTOCOMPARE_MISSING_PRICE_CACHE_SECS:
+                self._raise_no_price(from_asset=from_asset, to_asset=to_asset, timestamp=timestamp)
+            del self.missing_prices[missing_key]
+
         # NB: check if the from..to asset price (or viceversa) is a special
         # histohour API case.
         price = self._check_and_get_special_histohour_price(
@@ -1097,16 +1437,15 @@ class Cryptocompare(ExternalServiceWithApiKey):
         if price != Price(ZERO):
             return price
 
-        try:
-            data = self.get_historical_data(
+        data: Optional[PriceHistoryData] = None
+        if self._cache_covers_timestamp(from_asset, to_asset, timestamp):
+            # Use the cached columns directly instead of get_historical_data() which
+            # would copy the whole history into a list of entries
+            data = self._got_cached_data_at_timestamp(
                 from_asset=from_asset,
                 to_asset=to_asset,
                 timestamp=timestamp,
-                only_check_cache=True,
             )
-        except UnsupportedAsset as e:
-            raise PriceQueryUnsupportedAsset(e.asset_name) from e
-
         price = self._retrieve_price_from_data(
             data=data,
             from_asset=from_asset,
@@ -1115,22 +1454,19 @@ class Cryptocompare(ExternalServiceWithApiKey):
         )
         if price == Price(ZERO):
             log.debug(
-                f"Couldn't find historical price from {from_asset} to "
-                f"{to_asset} at timestamp {timestamp} through cryptocompare."
-                f" Attempting to get daily price...",
+                "Couldn't find historical price through cryptocompare. "
+                "Attempting to get daily price...",
+                from_asset=from_asset,
+                to_asset=to_asset,
+                timestamp=timestamp,
             )
             price = self.query_endpoint_pricehistorical(from_asset, to_asset, timestamp)
 
         if price == Price(ZERO):
-            raise NoPriceForGivenTimestamp(
-                from_asset=from_asset,
-                to_asset=to_asset,
-                date=timestamp_to_date(
-                    timestamp,
-                    formatstr='%d/%m/%Y, %H:%M:%S',
-                    treat_as_local=True,
-                ),
-            )
+            if len(self.missing_prices) >= CRYPTOCOMPARE_MISSING_PRICE_CACHE_SIZE:
+                self.missing_prices.popitem(last=False)
+            self.missing_prices[missing_key] = ts_now()
+            self._raise_no_price(from_asset=from_asset, to_asset=to_asset, timestamp=timestamp)
 
         log.debug(
             'Got historical price from cryptocompare',
@@ -1150,93 +1486,68 @@ class Cryptocompare(ExternalServiceWithApiKey):
         - RemoteError if there is a problem reaching the cryptocompare server
         or with reading the response returned by the server
         """
+        now = ts_now()
+        if self.coinlist_cache is not None:
+            coinlist_time, coinlist = self.coinlist_cache
+            if coinlist_time >= now or now - coinlist_time <= CRYPTOCOMPARE_COINLIST_CACHE_SECS:
+                return coinlist
+
         # Get coin list of cryptocompare
         invalidate_cache = True
-        coinlist_cache_path = os.path.join(self.data_directory, 'cryptocompare_coinlist.json')
+        coinlist_cache_path = os.path.join(self.data_directory, 'cryptocompare_coinlist.json.gz')
         if os.path.isfile(coinlist_cache_path):
             log.info('Found cryptocompare coinlist cache', path=coinlist_cache_path)
-            with open(coinlist_cache_path, 'r') as f:
-                try:
-                    data = jsonloads_dict(f.read())
-                    now = ts_now()
-                    invalidate_cache = False
-
-                    # If we got a cache and its' over a month old then requery cryptocompare
-                    if data['time'] < now and now - data['time'] > 2629800:
-                        log.info('Cryptocompare coinlist cache is now invalidated')
+            # The file is written right after querying the coinlist. If it was last
+            # modified over a month ago don't bother reading and parsing it.
+            if now - os.path.getmtime(coinlist_cache_path) > CRYPTOCOMPARE_COINLIST_CACHE_SECS:
+                log.info('Cryptocompare coinlist cache is now invalidated')
+            else:
+                with gzip.open(coinlist_cache_path, 'rb') as f:
+                    try:
+                        data = jsonloads_dict(f.read())
+                        invalidate_cache = False
+
+                        # If we got a cache and its' over a month old then requery cryptocompare
+                        if (
+                            data['time'] < now and
+                            now - data['time'] > CRYPTOCOMPARE_COINLIST_CACHE_SECS
+                        ):
+                            log.info('Cryptocompare coinlist cache is now invalidated')
+                            invalidate_cache = True
+                            data = data['data']
+                    except (JSONDecodeError, UnicodeDecodeError, OSError, EOFError, zlib.error):
                         invalidate_cache = True
-                        data = data['data']
-                except JSONDecodeError:
-                    invalidate_cache = True
 
         if invalidate_cache:
             data = self._api_query('all/coinlist')
+            coinlist_time = ts_now()
 
-            # Also save the cache
-            with open(coinlist_cache_path, 'w') as f:
-                now = ts_now()
-                log.info('Writing coinlist cache', timestamp=now)
-                write_data = {'time': now, 'data': data}
-                f.write(rlk_jsondumps(write_data))
+            # Also save the cache. Write it in a temporary file first and then move it
+            # in place so that a crash mid-write never leaves a truncated cache behind
+            log.info('Writing coinlist cache', timestamp=coinlist_time)
+            write_data = {'time': coinlist_time, 'data': data}
+            fd, tmp_cache_path = tempfile.mkstemp(dir=self.data_directory)
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    with gzip.GzipFile(fileobj=tmp_file, mode='wb', compresslevel=1) as f:
+                        # The coinlist is plain json from cryptocompare so write it without
+                        # any whitespace to keep the multi-MB file smaller and faster to read
+                        f.write(json.dumps(write_data, separators=(',', ':')).encode())
+                os.replace(tmp_cache_path, coinlist_cache_path)
+            finally:
+                # Only still there if writing or moving it failed
+                if os.path.exists(tmp_cache_path):
+                    os.remove(tmp_cache_path)
+            # Remove the uncompressed cache older versions wrote
+            try:
+                os.remove(os.path.join(self.data_directory, 'cryptocompare_coinlist.json'))
+            except FileNotFoundError:
+                pass
         else:
             # in any case take the data
+            coinlist_time = data['time']
             data = data['data']
 
-        # As described in the docs
-        # https://min-api.cryptocompare.com/documentation?key=Other&cat=allCoinsWithContentEndpoint
-        # This is not the entire list of assets in the system, so I am manually adding
-        # here assets I am aware of that they already have historical data for in thei
-        # cryptocompare system
-        data['DAO'] = object()
-        data['USDT'] = object()
-        data['VEN'] = object()
-        data['AIR*'] = object()  # This is Aircoin
-        # This is SpendCoin (https://coinmarketcap.com/currencies/spendcoin/)
-        data['SPND'] = object()
-        # This is eBitcoinCash (https://coinmarketcap.com/currencies/ebitcoin-cash/)
-        data['EBCH'] = object()
-        # This is Educare (https://coinmarketcap.com/currencies/educare/)
-        data['EKT'] = object()
-        # This is Knoxstertoken (https://coinmarketcap.com/currencies/knoxstertoken/)
-        data['FKX'] = object()
-        # This is FNKOS (https://coinmarketcap.com/currencies/fnkos/)
-        data['FNKOS'] = object()
-        # This is FansTime (https://coinmarketcap.com/currencies/fanstime/)
-        data['FTI'] = object()
-        # This is Gene Source Code Chain
-        # (https://coinmarketcap.com/currencies/gene-source-code-chain/)
-        data['GENE*'] = object()
-        # This is GazeCoin (https://coinmarketcap.com/currencies/gazecoin/)
-        data['GZE'] = object()
-        # This is probaly HarmonyCoin (https://coinmarketcap.com/currencies/harmonycoin-hmc/)
-        data['HMC*'] = object()
-        # This is IoTChain (https://coinmarketcap.com/currencies/iot-chain/)
-        data['ITC'] = object()
-        # This is Luna Coin (https://coinmarketcap.com/currencies/luna-coin/)
-        data['LUNA'] = object
-        # This is MFTU (https://coinmarketcap.com/currencies/mainstream-for-the-underground/)
-        data['MFTU'] = object()
-        # This is Nexxus (https://coinmarketcap.com/currencies/nexxus/)
-        data['NXX'] = object()
-        # This is Owndata (https://coinmarketcap.com/currencies/owndata/)
-        data['OWN'] = object()
-        # This is PiplCoin (https://coinmarketcap.com/currencies/piplcoin/)
-        data['PIPL'] = object()
-        # This is PKG Token (https://coinmarketcap.com/currencies/pkg-token/)
-        data['PKG'] = object()
-        # This is Quibitica https://coinmarketcap.com/currencies/qubitica/
-        data['QBIT'] = object()
-        # This is DPRating https://coinmarketcap.com/currencies/dprating/
-        data['RATING'] = object()
-        # This is RocketPool https://coinmarketcap.com/currencies/rocket-pool/
-        data['RPL'] = object()
-        # This is SpeedMiningService (https://coinmarketcap.com/currencies/speed-mining-service/)
-        data['SMS'] = object()
-        # This is SmartShare (https://coinmarketcap.com/currencies/smartshare/)
-        data['SSP'] = object()
-        # This is ThoreCoin (https://coinmarketcap.com/currencies/thorecoin/)
-        data['THR'] = object()
-        # This is Transcodium (https://coinmarketcap.com/currencies/transcodium/)
-        data['TNS'] = object()
-
+        data.update(dict.fromkeys(_CRYPTOCOMPARE_EXTRA_ASSETS, _EXTRA_ASSET_SENTINEL))
+        self.coinlist_cache = (coinlist_time, data)
         return data
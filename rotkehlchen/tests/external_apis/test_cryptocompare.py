@@ -1,27 +1,37 @@
+import gzip
+import json
 import os
 import warnings as test_warnings
 from datetime import datetime
 from typing import List
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 
 from rotkehlchen.assets.asset import Asset
 from rotkehlchen.constants.assets import A_BTC, A_ETH, A_USD, A_USDT
 from rotkehlchen.constants.misc import ZERO
-from rotkehlchen.errors import NoPriceForGivenTimestamp
+from rotkehlchen.errors import NoPriceForGivenTimestamp, RemoteError
+from rotkehlchen.externalapis.coingecko import Coingecko
 from rotkehlchen.externalapis.cryptocompare import (
     A_COMP,
     CRYPTOCOMPARE_HOURQUERYLIMIT,
+    CRYPTOCOMPARE_MISSING_PRICE_CACHE_SECS,
     CRYPTOCOMPARE_SPECIAL_HISTOHOUR_CASES,
+    LEGACY_PRICE_HISTORY_FILE_PREFIX,
     PRICE_HISTORY_FILE_PREFIX,
     Cryptocompare,
     PairCacheKey,
+    PriceHistoryData,
+    _check_hourly_data_sanity,
+    _write_history_data_in_file,
 )
 from rotkehlchen.fval import FVal
+from rotkehlchen.history.price import PriceHistorian
+from rotkehlchen.history.typing import HistoricalPriceOracle
 from rotkehlchen.tests.utils.constants import A_SNGLS, A_XMR
 from rotkehlchen.typing import Price, Timestamp
-from rotkehlchen.utils.misc import get_or_make_price_history_dir
+from rotkehlchen.utils.misc import get_or_make_price_history_dir, ts_now
 
 
 def test_cryptocompare_query_pricehistorical(cryptocompare):
@@ -35,6 +45,23 @@ def test_cryptocompare_query_pricehistorical(cryptocompare):
     assert price
 
 
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_pricehistorical_daily_cache(data_dir, database, freezer):
+    """Test that the daily price of a past day is queried only once and the current one always"""
+    now_ts = 1609502400  # 01/01/2021 12:00 UTC
+    freezer.move_to(datetime.fromtimestamp(now_ts))
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    with patch.object(cc, '_api_query', return_value={'SNGLS': {'BTC': 0.5}}) as mock:
+        for timestamp in (1609372800, 1609416000, 1609459199):  # all on 31/12/2020
+            price = cc.query_endpoint_pricehistorical(A_SNGLS, A_BTC, Timestamp(timestamp))
+            assert price == FVal('0.5')
+        assert mock.call_count == 1
+
+        for _ in range(2):
+            cc.query_endpoint_pricehistorical(A_SNGLS, A_BTC, Timestamp(now_ts - 60))
+        assert mock.call_count == 3
+
+
 @pytest.mark.parametrize('use_clean_caching_directory', [True])
 def test_cryptocompare_historical_data_use_cached_price(data_dir, database):
     """Test that the cryptocompare cache is used and also properly deserialized"""
@@ -44,7 +71,7 @@ def test_cryptocompare_historical_data_use_cached_price(data_dir, database):
     "volumefrom": 10, "volumeto": 10}, {"time": 1438390800, "close": 20, "high": 20,
     "low": 20, "open": 20, "volumefrom": 20, "volumeto": 20}]}"""
     price_history_dir = get_or_make_price_history_dir(data_dir)
-    with open(price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json', 'w') as f:
+    with open(price_history_dir / f'{LEGACY_PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json', 'w') as f:
         f.write(contents)
 
     cc = Cryptocompare(data_directory=data_dir, database=database)
@@ -54,7 +81,7 @@ def test_cryptocompare_historical_data_use_cached_price(data_dir, database):
             to_asset=A_BTC,
             timestamp=1438390801,
             only_check_cache=False,
-        )
+        ).entries()
         # make sure that histohour was not called, in essence that the cache was used
         assert histohour_mock.call_count == 0
 
@@ -69,6 +96,172 @@ def test_cryptocompare_historical_data_use_cached_price(data_dir, database):
     assert result[1].high == FVal(20)
 
 
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_cache_file_roundtrip(data_dir, database):
+    """Test that history written in the columnar cache format is properly read back"""
+    data = [
+        {'time': 1438387200, 'close': 10, 'high': 11, 'low': 9, 'open': 10},
+        {'time': 1438390800, 'close': 20, 'high': FVal('21.5'), 'low': FVal('19.5'), 'open': 20},
+    ]
+    price_history_dir = get_or_make_price_history_dir(data_dir)
+    _write_history_data_in_file(
+        data=data,
+        filepath=price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json',
+        start_ts=Timestamp(1438387200),
+        end_ts=Timestamp(1438394400),
+    )
+
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    assert cc.get_cached_data_metadata(from_asset=A_SNGLS, to_asset=A_BTC) == (
+        1438387200,
+        1438394400,
+    )
+    result = cc.get_cached_data(from_asset=A_SNGLS, to_asset=A_BTC)
+    assert result is not None
+    assert result.times == [1438387200, 1438390800]
+    assert result.lows == [FVal(9), FVal('19.5')]
+    assert result.highs == [FVal(11), FVal('21.5')]
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_legacy_cache_file(data_dir, database, freezer):
+    """Test that a cache file of the old list format is read if no columnar one exists
+    and that updating it writes a new file, leaving the old one for older versions"""
+    start_ts = 1609459200
+    contents = json.dumps({
+        'start_time': start_ts,
+        'end_time': start_ts + 3600,
+        'data': [{'time': start_ts + 3600 * i, 'low': 1, 'high': 1} for i in range(2)],
+    })
+    price_history_dir = get_or_make_price_history_dir(data_dir)
+    legacy_path = price_history_dir / f'{LEGACY_PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json'
+    with open(legacy_path, 'w') as f:
+        f.write(contents)
+    now_ts = start_ts + 3600 * 3
+    freezer.move_to(datetime.fromtimestamp(now_ts))
+
+    def mock_histohour(limit, to_timestamp, **_kwargs):
+        time_from = to_timestamp - limit * 3600
+        return {
+            'TimeFrom': time_from,
+            'TimeTo': to_timestamp,
+            'Data': [
+                {'time': time_from + 3600 * i, 'close': '2', 'low': '2', 'high': '2'}
+                for i in range(limit + 1)
+            ],
+        }
+
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    with patch.object(cc, 'query_endpoint_histohour', side_effect=mock_histohour):
+        result = cc.get_historical_data(
+            from_asset=A_SNGLS,
+            to_asset=A_BTC,
+            timestamp=Timestamp(now_ts - 100),
+            only_check_cache=False,
+        )
+
+    assert result is not None
+    assert result.times == [start_ts + 3600 * i for i in range(4)]
+    with open(legacy_path, 'r') as f:
+        assert f.read() == contents
+    # a new instance picks the columnar file over the legacy one
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    assert cc.get_cached_data_metadata(from_asset=A_SNGLS, to_asset=A_BTC) == (
+        start_ts,
+        now_ts,
+    )
+
+    cc.delete_cache(from_asset=A_SNGLS, to_asset=A_BTC)
+    assert not legacy_path.exists()
+    assert not (price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json').exists()
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_cache_file_missing_column(data_dir, database):
+    """Test that a cache file missing one of the data columns is treated as no cache"""
+    price_history_dir = get_or_make_price_history_dir(data_dir)
+    with open(price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json', 'w') as f:
+        json.dump({'start_time': 1, 'end_time': 2, 'data': {'time': [1], 'low': [1]}}, f)
+
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    assert cc.get_cached_data(from_asset=A_SNGLS, to_asset=A_BTC) is None
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_extend_cache_not_in_memory(data_dir, database, freezer):
+    """Test that querying after the end of a cache file that is not yet loaded in memory
+    only queries the missing hours instead of the entire history again"""
+    start_ts = 1609459200
+    end_ts = start_ts + 3600 * 2
+    price_history_dir = get_or_make_price_history_dir(data_dir)
+    _write_history_data_in_file(
+        data=[{'time': start_ts + 3600 * i, 'low': 1, 'high': 1} for i in range(3)],
+        filepath=price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json',
+        start_ts=Timestamp(start_ts),
+        end_ts=Timestamp(end_ts),
+    )
+    now_ts = start_ts + 3600 * 10
+    freezer.move_to(datetime.fromtimestamp(now_ts))
+
+    def mock_histohour(limit, to_timestamp, **_kwargs):
+        time_from = to_timestamp - limit * 3600
+        return {
+            'TimeFrom': time_from,
+            'TimeTo': to_timestamp,
+            'Data': [
+                {'time': time_from + 3600 * i, 'close': '2', 'low': '2', 'high': '2'}
+                for i in range(limit + 1)
+            ],
+        }
+
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    with patch.object(cc, 'query_endpoint_histohour', side_effect=mock_histohour) as mock:
+        result = cc.get_historical_data(
+            from_asset=A_SNGLS,
+            to_asset=A_BTC,
+            timestamp=Timestamp(now_ts - 100),
+            only_check_cache=False,
+        ).entries()
+        assert mock.call_count == 1
+        assert mock.call_args[1]['to_timestamp'] == now_ts
+
+    assert [x.time for x in result] == [start_ts + 3600 * i for i in range(11)]
+    assert [x.low for x in result] == [FVal(1)] * 3 + [FVal(2)] * 8
+    assert cc.price_history[PairCacheKey('SNGLS_BTC')].start_time == start_ts
+    assert cc.price_history[PairCacheKey('SNGLS_BTC')].end_time == now_ts
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_price_historian_out_of_range_does_not_load_cache(data_dir, database):
+    """Test that querying a price outside of the cached range of a pair through the
+    price historian does not load the entire cache file in memory"""
+    start_ts = 1609459200
+    price_history_dir = get_or_make_price_history_dir(data_dir)
+    _write_history_data_in_file(
+        data=[{'time': start_ts + 3600 * i, 'low': 1, 'high': 1} for i in range(3)],
+        filepath=price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}SNGLS_BTC.json',
+        start_ts=Timestamp(start_ts),
+        end_ts=Timestamp(start_ts + 3600 * 2),
+    )
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    PriceHistorian._PriceHistorian__instance = None
+    historian = PriceHistorian(
+        data_directory=data_dir,
+        cryptocompare=cc,
+        coingecko=MagicMock(spec=Coingecko),
+    )
+    historian.set_oracles_order([HistoricalPriceOracle.CRYPTOCOMPARE])
+    with patch.object(cc, 'query_endpoint_pricehistorical', return_value=Price(FVal(2))):
+        price = PriceHistorian().query_historical_price(
+            from_asset=A_SNGLS,
+            to_asset=A_BTC,
+            timestamp=Timestamp(start_ts + 3600 * 5),
+        )
+
+    assert price == FVal(2)
+    assert cc.price_history == {}
+
+
 def check_cc_result(query_result: List, forward: bool):
     for idx, entry in enumerate(query_result):
         if idx != 0:
@@ -108,14 +301,14 @@ def test_cryptocompare_histohour_data_going_forward(data_dir, database, freezer)
         to_asset=A_USD,
         timestamp=now_ts - 3600 * 2 - 55,
         only_check_cache=False,
-    )
+    ).entries()
     cache_key = PairCacheKey('BTC_USD')
     assert len(result) == CRYPTOCOMPARE_HOURQUERYLIMIT + 1
     assert all(x.low == x.high == FVal('0.05454') for x in result)
     assert cache_key in cc.price_history
     assert cc.price_history[cache_key].start_time == btc_start_ts
     assert cc.price_history[cache_key].end_time == now_ts
-    assert all(x.low == x.high == FVal('0.05454') for x in cc.price_history[cache_key].data)
+    assert all(x.low == x.high == FVal('0.05454') for x in cc.price_history[cache_key].entries())
 
     # now let's move a bit to the future and query again to see the cache is appended to
     now_ts = now_ts + 3600 * 2000 * 2 + 4700
@@ -125,13 +318,13 @@ def test_cryptocompare_histohour_data_going_forward(data_dir, database, freezer)
         to_asset=A_USD,
         timestamp=now_ts - 3600 * 4 - 55,
         only_check_cache=False,
-    )
+    ).entries()
     assert len(result) == CRYPTOCOMPARE_HOURQUERYLIMIT * 3 + 2
     check_cc_result(result, forward=True)
     assert cache_key in cc.price_history
     assert cc.price_history[cache_key].start_time == btc_start_ts
     assert cc.price_history[cache_key].end_time == now_ts
-    check_cc_result(cc.price_history[cache_key].data, forward=True)
+    check_cc_result(cc.price_history[cache_key].entries(), forward=True)
 
 
 @pytest.mark.freeze_time
@@ -154,7 +347,7 @@ def test_cryptocompare_histohour_data_going_backward(data_dir, database, freezer
     "volumefrom": 0.298, "volumeto": 0.298}, {"time": 1301540400, "close": 0.298, "high": 0.298,
     "low": 0.298, "open": 0.298, "volumefrom": 0.298, "volumeto": 0.298}]}"""
     price_history_dir = get_or_make_price_history_dir(data_dir)
-    with open(price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}BTC_USD.json', 'w') as f:
+    with open(price_history_dir / f'{LEGACY_PRICE_HISTORY_FILE_PREFIX}BTC_USD.json', 'w') as f:
         f.write(contents)
     freezer.move_to(datetime.fromtimestamp(now_ts))
     cc = Cryptocompare(data_directory=data_dir, database=database)
@@ -163,21 +356,21 @@ def test_cryptocompare_histohour_data_going_backward(data_dir, database, freezer
         to_asset=A_USD,
         timestamp=now_ts - 3600 * 2 - 55,
         only_check_cache=False,
-    )
+    ).entries()
     cache_key = PairCacheKey('BTC_USD')
     assert len(result) == CRYPTOCOMPARE_HOURQUERYLIMIT * 3 + 2
     check_cc_result(result, forward=False)
     assert cache_key in cc.price_history
     assert cc.price_history[cache_key].start_time == btc_start_ts
     assert cc.price_history[cache_key].end_time == now_ts
-    check_cc_result(cc.price_history[cache_key].data, forward=False)
+    check_cc_result(cc.price_history[cache_key].entries(), forward=False)
 
 
 @pytest.mark.parametrize('use_clean_caching_directory', [True])
 def test_empty_histohour(data_dir, database, freezer):
     """Histohour can be empty and can have also floating point zeros like in CHI/EUR
 
-    This test makes sure that an empty list is returned at the very first all zeros
+    This test makes sure that nothing is returned at the very first all zeros
     result that also has floating point and querying stops.
 
     If cryptocompare actually fixes their zero historical price problem this test can go away
@@ -191,7 +384,7 @@ def test_empty_histohour(data_dir, database, freezer):
         timestamp=now_ts,
         only_check_cache=False,
     )
-    assert len(result) == 0
+    assert result is None
 
 
 @pytest.mark.parametrize('use_clean_caching_directory', [True])
@@ -247,7 +440,7 @@ def test_get_cached_data_metadata(data_dir, database):
     """
     contents = """{"start_time": 1301536800, "end_time": 1301540400, "data": [{"time": 1301536800, "close": 0.298, "high": 0.298, "low": 0.298, "open": 0.298, "volumefrom": 0.298, "volumeto": 0.298}, {"time": 1301540400, "close": 0.298, "high": 0.298, "low": 0.298, "open": 0.298, "volumefrom": 0.298, "volumeto": 0.298}]}"""  # noqa: E501
     price_history_dir = get_or_make_price_history_dir(data_dir)
-    with open(price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}BTC_USD.json', 'w') as f:
+    with open(price_history_dir / f'{LEGACY_PRICE_HISTORY_FILE_PREFIX}BTC_USD.json', 'w') as f:
         f.write(contents)
     cc = Cryptocompare(data_directory=data_dir, database=database)
     # make sure that _read_cachefile_metadata runs and they are read from file and not from memory
@@ -283,7 +476,7 @@ def test_cryptocompare_historical_data_price(
     """
     cc = Cryptocompare(data_directory=data_dir, database=database)
     # Get lots of historical prices from at least 1 query after the ts we need
-    result = cc.get_historical_data(
+    cc.get_historical_data(
         from_asset=from_asset,
         to_asset=to_asset,
         timestamp=timestamp + 2020 * 3600,
@@ -291,7 +484,7 @@ def test_cryptocompare_historical_data_price(
     )
     # Query the ts we need from the cached data
     result_price = cc._retrieve_price_from_data(
-        data=result,
+        data=cc.get_cached_data(from_asset=from_asset, to_asset=to_asset),
         from_asset=from_asset,
         to_asset=to_asset,
         timestamp=timestamp,
@@ -443,3 +636,81 @@ def test_cryptocompare_query_with_api_key(cryptocompare):
     # call to endpoint with args
     price = cryptocompare.query_current_price(A_ETH, A_USD)
     assert price is not None
+
+
+def test_check_hourly_data_sanity():
+    """Test that gaps between any two consecutive hourly entries are detected"""
+    data = [{'time': 1609459200 + idx * 3600} for idx in range(5)]
+    _check_hourly_data_sanity(data, A_BTC, A_USD)
+
+    # A gap between the 2nd and 3rd entry used to go unnoticed
+    data[2]['time'] += 1
+    with pytest.raises(RemoteError) as e:
+        _check_hourly_data_sanity(data, A_BTC, A_USD)
+    assert 'Problem at indices 1 and 2' in str(e.value)
+
+
+@pytest.mark.parametrize('timestamp, expected_price', [
+    (1609459199, ZERO),  # before the first entry
+    (1609459200, FVal(10)),
+    (1609460999, FVal(10)),  # closer to the first entry
+    (1609461000, FVal(10)),  # equally close to both, take the earlier
+    (1609461001, FVal(20)),  # closer to the second entry
+    (1609469999, FVal(30)),  # after the last entry but within the hour
+    (1609470000, ZERO),  # an hour after the last entry
+])
+def test_retrieve_price_from_data(timestamp, expected_price):
+    """Test that the closest hourly entry to the timestamp is used for the price"""
+    data = PriceHistoryData(
+        times=[Timestamp(1609459200), Timestamp(1609462800), Timestamp(1609466400)],
+        lows=[Price(FVal(9)), Price(FVal(19)), Price(FVal(29))],
+        highs=[Price(FVal(11)), Price(FVal(21)), Price(FVal(31))],
+        start_time=Timestamp(1609459200),
+        end_time=Timestamp(1609470000),
+    )
+    price = Cryptocompare._retrieve_price_from_data(
+        data=data,
+        from_asset=A_BTC,
+        to_asset=A_USD,
+        timestamp=timestamp,
+    )
+    assert price == expected_price
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_remembers_missing_prices(data_dir, database, freezer):
+    """Test that a price that could not be found is not queried again for a while"""
+    now_ts = 1609459200
+    freezer.move_to(datetime.fromtimestamp(now_ts))
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    with patch.object(cc, 'query_endpoint_pricehistorical', return_value=Price(ZERO)) as mock:
+        for _ in range(2):
+            with pytest.raises(NoPriceForGivenTimestamp):
+                cc.query_historical_price(A_SNGLS, A_BTC, Timestamp(1438387200))
+        assert mock.call_count == 1
+
+        freezer.move_to(datetime.fromtimestamp(now_ts + CRYPTOCOMPARE_MISSING_PRICE_CACHE_SECS))
+        with pytest.raises(NoPriceForGivenTimestamp):
+            cc.query_historical_price(A_SNGLS, A_BTC, Timestamp(1438387200))
+        assert mock.call_count == 2
+
+
+@pytest.mark.parametrize('use_clean_caching_directory', [True])
+def test_cryptocompare_coinlist_corrupt_cache(data_dir, database):
+    """Test that a truncated coinlist cache is ignored and the coinlist queried again"""
+    coinlist_path = data_dir / 'cryptocompare_coinlist.json.gz'
+    contents = gzip.compress(json.dumps({'time': ts_now(), 'data': {'BTC': {}}}).encode())
+    with open(coinlist_path, 'wb') as f:
+        f.write(contents[:len(contents) // 2])
+
+    cc = Cryptocompare(data_directory=data_dir, database=database)
+    with patch.object(cc, '_api_query', return_value={'ETH': {}}) as mock:
+        coins = cc.all_coins()
+        assert mock.call_count == 1
+        assert mock.call_args[0][0] == 'all/coinlist'
+
+    assert 'ETH' in coins and 'BTC' not in coins
+    with gzip.open(coinlist_path, 'rb') as f:
+        assert json.loads(f.read())['data'] == {'ETH': {}}
+    # no temporary file is left behind
+    assert not any(x.name.startswith('tmp') for x in data_dir.iterdir())
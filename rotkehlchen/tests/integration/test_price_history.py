@@ -2,7 +2,7 @@ import pytest
 
 from rotkehlchen.assets.asset import Asset
 from rotkehlchen.constants.assets import A_BTC, A_USD
-from rotkehlchen.externalapis.cryptocompare import PRICE_HISTORY_FILE_PREFIX, Cryptocompare
+from rotkehlchen.externalapis.cryptocompare import LEGACY_PRICE_HISTORY_FILE_PREFIX, Cryptocompare
 from rotkehlchen.fval import FVal
 from rotkehlchen.tests.utils.constants import A_DASH, A_EUR, A_XMR
 from rotkehlchen.utils.misc import get_or_make_price_history_dir
@@ -23,7 +23,7 @@ def test_price_queries(price_historian, data_dir, database):
     "volumefrom": 10, "volumeto": 10}, {"time": 1438390800, "close": 20, "high": 20,
     "low": 20, "open": 20, "volumefrom": 20, "volumeto": 20}]}"""
     price_history_dir = get_or_make_price_history_dir(data_dir)
-    with open(price_history_dir / f'{PRICE_HISTORY_FILE_PREFIX}DASH_USD.json', 'w') as f:
+    with open(price_history_dir / f'{LEGACY_PRICE_HISTORY_FILE_PREFIX}DASH_USD.json', 'w') as f:
         f.write(contents)
     price_historian._PriceHistorian__instance._cryptocompare = Cryptocompare(
         data_directory=data_dir,
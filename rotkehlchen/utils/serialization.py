@@ -34,7 +34,7 @@ class RKLEncoder(json.JSONEncoder):
         return super().encode(self._encode(obj))
 
 
-def jsonloads_dict(data: str) -> Dict[str, Any]:
+def jsonloads_dict(data: Union[str, bytes]) -> Dict[str, Any]:
     value = json.loads(data)
     assert isinstance(value, dict)
     return value